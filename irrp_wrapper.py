@@ -15,6 +15,9 @@ where
 
 and 1 2 3 4 5 6 is a list of codes to record.
 
+Codes identical to the code of another id are stored in the file
+as a reference to that id, e.g. "6": {"__ref__": "5"}.
+
 To playback use
 
 ./irrp_wrapper.py -p -g17 -fcodes 2 3 4
@@ -55,10 +58,43 @@ import time
 import json
 import os
 import argparse
+import array
 
 import pigpio # http://abyz.co.uk/rpi/pigpio/python.html
 
 
+REF = "__ref__" # Key of a code stored as a reference to an identical code.
+
+def share_codes(records):
+   """
+   Return a copy of records where each code identical to a code with
+   an earlier id is stored as {"__ref__": earlier_id}.
+   """
+   seen = {}
+   shared = {}
+   for rec in sorted(records):
+      key = tuple(records[rec])
+      if key in seen:
+         shared[rec] = {REF: seen[key]}
+      else:
+         seen[key] = rec
+         shared[rec] = records[rec]
+   return shared
+
+def resolve_codes(records):
+   """
+   Replace each {"__ref__": id} entry of records in place with its
+   own copy of the code stored under id.  A reference must be to a
+   code, not to another reference.
+   """
+   refs = [rec for rec in records if isinstance(records[rec], dict)]
+   for rec in refs:
+      if records[rec][REF] in refs:
+         raise ValueError("Id {} refers to another reference".format(rec))
+   for rec in refs:
+      records[rec] = list(records[records[rec][REF]])
+   return records
+
 
 class irrp:
    def __init__(self, verbose=False):
@@ -76,20 +112,14 @@ class irrp:
          """
          f -> f.bak -> f.bak1 -> f.bak2
          """
-         try:
-            os.rename(os.path.realpath(f)+".bak1", os.path.realpath(f)+".bak2")
-         except:
-            pass
-
-         try:
-            os.rename(os.path.realpath(f)+".bak", os.path.realpath(f)+".bak1")
-         except:
-            pass
-
-         try:
-            os.rename(os.path.realpath(f), os.path.realpath(f)+".bak")
-         except:
-            pass
+         rp = os.path.realpath(f)
+         for src, dst in [(rp+".bak1", rp+".bak2"),
+                          (rp+".bak",  rp+".bak1"),
+                          (rp,         rp+".bak")]:
+            try:
+               os.replace(src, dst)
+            except FileNotFoundError:
+               pass
 
       def normalise(c):
          """
@@ -128,31 +158,30 @@ class irrp:
          """
          if self.VERBOSE:
             print("before normalise", c)
-         entries = len(c)
-         p = [0]*entries # Set all entries not processed.
-         for i in range(entries):
-            if not p[i]: # Not processed?
-               v = c[i]
-               tot = v
-               similar = 1.0
-
-               # Find all pulses with similar lengths to the start pulse.
-               for j in range(i+2, entries, 2):
-                  if not p[j]: # Unprocessed.
-                     if (c[j]*TOLER_MIN) < v < (c[j]*TOLER_MAX): # Similar.
-                        tot = tot + c[j]
-                        similar += 1.0
-
-               # Calculate the average pulse length.
-               newv = round(tot / similar, 2)
-               c[i] = newv
-
-               # Set all similar pulses to the average value.
-               for j in range(i+2, entries, 2):
-                  if not p[j]: # Unprocessed.
-                     if (c[j]*TOLER_MIN) < v < (c[j]*TOLER_MAX): # Similar.
-                        c[j] = newv
-                        p[j] = 1
+         tmax = TOLER_MAX
+         for base in (0, 1): # Marks then spaces.
+
+            # Visit the pulses shortest first so that similar pulses
+            # are adjacent and can be grouped in a single sweep.
+            idx = sorted(range(base, len(c), 2), key=c.__getitem__)
+
+            group = []
+            for i in idx:
+               if group and c[i] >= limit: # Not similar, close group.
+                  newv = int(round(tot / float(len(group))))
+                  for j in group:
+                     c[j] = newv
+                  group = []
+               if not group:
+                  limit = c[i]*tmax # Group's tolerance window.
+                  tot = 0
+               group.append(i)
+               tot += c[i]
+
+            if group:
+               newv = int(round(tot / float(len(group))))
+               for j in group:
+                  c[j] = newv
 
          if self.VERBOSE:
             print("after normalise", c)
@@ -160,7 +189,8 @@ class irrp:
       def compare(p1, p2):
          """
          Check that both recodings correspond in pulse length to within
-         TOLERANCE%.  If they do average the two recordings pulse lengths.
+         TOLERANCE%.  If they do return the average of the two recordings
+         pulse lengths, otherwise None.  Neither recording is changed.
 
          Input
 
@@ -173,46 +203,38 @@ class irrp:
          A: 9010 4535 595 555 595 555 595 1670 595 1670 595
          """
          if len(p1) != len(p2):
-            return False
+            return None
 
-         for i in range(len(p1)):
-            v = p1[i] / p2[i]
-            if (v < TOLER_MIN) or (v > TOLER_MAX):
-               return False
+         tmin = TOLER_MIN
+         tmax = TOLER_MAX
+         if not all(tmin <= a/b <= tmax for a, b in zip(p1, p2)):
+            return None
 
-         for i in range(len(p1)):
-            p1[i] = int(round((p1[i]+p2[i])/2.0))
+         avg = [int(round((a+b)/2.0)) for a, b in zip(p1, p2)]
 
          if self.VERBOSE:
-            print("after compare", p1)
+            print("after compare", avg)
 
-         return True
+         return avg
 
-      def tidy_mark_space(records, base):
+      def tidy_mark_space(ms):
 
-         ms = {}
-
-         # Find all the unique marks (base=0) or spaces (base=1)
-         # and count the number of times they appear,
-
-         for rec in records:
-            rl = len(records[rec])
-            for i in range(base, rl, 2):
-               if records[rec][i] in ms:
-                  ms[records[rec][i]] += 1
-               else:
-                  ms[records[rec][i]] = 1
+         # ms maps each unique mark or space length to the number
+         # of times it appears, it is changed in place to map each
+         # length to the length it should be replaced with.
 
          if self.VERBOSE:
             print("t_m_s A", ms)
 
-         v = None
+         if not ms:
+            return
 
-         print("--------------------------")
-         print("titidy_mark_space ms:", ms)
-         print("--------------------------")
+         plens = sorted(ms)
+         counts = [ms[plen] for plen in plens]
+
+         v = None
 
-         for plen in sorted(ms):
+         for plen, n in zip(plens, counts):
 
             # Now go through in order, shortest first, and collapse
             # pulses which are the same within a tolerance to the
@@ -226,13 +248,14 @@ class irrp:
             if v == None:
                e = [plen]
                v = plen
-               tot = plen * ms[plen]
-               similar = ms[plen]
+               limit = v*TOLER_MAX
+               tot = plen * n
+               similar = n
 
-            elif plen < (v*TOLER_MAX):
+            elif plen < limit:
                e.append(plen)
-               tot += (plen * ms[plen])
-               similar += ms[plen]
+               tot += (plen * n)
+               similar += n
 
             else:
                v = int(round(tot/float(similar)))
@@ -241,47 +264,69 @@ class irrp:
                   ms[i] = v
                e = [plen]
                v = plen
-               tot = plen * ms[plen]
-               similar = ms[plen]
+               limit = v*TOLER_MAX
+               tot = plen * n
+               similar = n
 
-            v = int(round(tot/float(similar)))
-            # set all previous to v
-            for i in e:
-               ms[i] = v
+         v = int(round(tot/float(similar)))
+         # set all previous to v
+         for i in e:
+            ms[i] = v
 
-            if self.VERBOSE:
-               print("t_m_s B", ms)
+         if self.VERBOSE:
+            print("t_m_s B", ms)
 
-            for rec in records:
-               rl = len(records[rec])
-               for i in range(base, rl, 2):
-                  records[rec][i] = ms[records[rec][i]]
+      def tidy(records):
 
-         
+         marks = {}
+         spaces = {}
+
+         # Find all the unique marks and spaces and count the
+         # number of times they appear.
+
+         for rec in records:
+            lst = records[rec]
+            for plen in lst[0::2]:
+               marks[plen] = marks.get(plen, 0) + 1
+            for plen in lst[1::2]:
+               spaces[plen] = spaces.get(plen, 0) + 1
+
+         tidy_mark_space(marks) # Marks.
+         tidy_mark_space(spaces) # Spaces.
+
+         # Remap every record once now all the groups are known.
+         for rec in records:
+            lst = records[rec]
+            lst[0::2] = [marks[plen] for plen in lst[0::2]]
+            lst[1::2] = [spaces[plen] for plen in lst[1::2]]
 
-      def tidy(records):
-         tidy_mark_space(records, 0) # Marks.
-         tidy_mark_space(records, 1) # Spaces.
          return records
 
       def end_of_code():
          #global code, fetching_code
-         if len(self.code) > SHORT:
+         if self._code_n > len(self._code_buf):
+            self._code_n = 0
+            print("Code too long, try again")
+         elif self._code_n > SHORT:
+            self.code = self._code_buf[:self._code_n].tolist()
             normalise(self.code)
             self.fetching_code = False
          else:
-            self.code = []
+            self._code_n = 0
             print("Short code, probably a repeat, try again")
 
 
 
-      def cbf(gpio, level, tick):
+      def cbf(gpio, level, tick, TIMEOUT=pigpio.TIMEOUT, tickDiff=pigpio.tickDiff):
 
          #global last_tick, in_code, code, fetching_code
 
-         if level != pigpio.TIMEOUT:
+         # Called for every edge, the pigpio names are bound as defaults
+         # so they are plain local lookups.
 
-            edge = pigpio.tickDiff(self.last_tick, tick)
+         if level != TIMEOUT:
+
+            edge = tickDiff(self.last_tick, tick)
             self.last_tick = tick
 
             if self.fetching_code:
@@ -296,7 +341,12 @@ class irrp:
                   end_of_code()
 
                elif self.in_code:
-                  self.code.append(edge)
+                  # Keep counting once the buffer is full so that
+                  # end_of_code can reject the overflowed code.
+                  n = self._code_n
+                  if n < len(self._code_buf):
+                     self._code_buf[n] = edge
+                  self._code_n = n + 1
 
          else:
             pi.set_watchdog(gpio, 0) # Cancel watchdog.
@@ -329,10 +379,17 @@ class irrp:
       except:
          records = {}
 
+      resolve_codes(records)
+
       pi.set_mode(gpio, pigpio.INPUT) # IR RX connected to this GPIO.
 
       pi.set_glitch_filter(gpio, glitch) # Ignore glitches.
 
+      # Edges are stored in a preallocated buffer so the callback
+      # doesn't allocate while a code is arriving.
+      self._code_buf = array.array('i', [0]) * 4096
+      self._code_n = 0
+
       cb = pi.callback(gpio, pigpio.EITHER_EDGE, cbf)
 
       # Process each id
@@ -341,7 +398,7 @@ class irrp:
       #for arg in args.id:
       for arg in id_list:
          print("Press key for '{}'".format(arg))
-         self.code = []
+         self._code_n = 0
          self.fetching_code = True
          while self.fetching_code:
             time.sleep(0.1)
@@ -349,21 +406,21 @@ class irrp:
          time.sleep(0.5)
 
          if CONFIRM:
-            press_1 = self.code[:]
+            press_1 = self.code # Replaced, not changed, by the next press.
             done = False
 
             tries = 0
             while not done:
                print("Press key for '{}' to confirm".format(arg))
-               self.code = []
+               self._code_n = 0
                self.fetching_code = True
                while self.fetching_code:
                   time.sleep(0.1)
-               press_2 = self.code[:]
-               the_same = compare(press_1, press_2)
-               if the_same:
+               press_2 = self.code
+               avg = compare(press_1, press_2)
+               if avg is not None:
                   done = True
-                  records[arg] = press_1[:]
+                  records[arg] = avg
                   print("Okay")
                   time.sleep(0.5)
                else:
@@ -375,17 +432,25 @@ class irrp:
                      done = True
                   time.sleep(0.5)
          else: # No confirm.
-            records[arg] = self.code[:]
+            records[arg] = self.code
 
       pi.set_glitch_filter(gpio, 0) # Cancel glitch filter.
       pi.set_watchdog(gpio, 0) # Cancel watchdog.
 
-      ##records = tidy(records)  # TODO: Fix Error.
+      records = tidy(records)
+
+      records = share_codes(records) # Store repeated codes once.
 
       backup(FILE)
 
+      # One code per line, written as it is encoded.
       f = open(FILE, "w")
-      f.write(json.dumps(records, sort_keys=True).replace("],", "],\n")+"\n")
+      f.write("{")
+      sep = ""
+      for rec in sorted(records):
+         f.write(sep + json.dumps(rec) + ": " + json.dumps(records[rec]))
+         sep = ",\n "
+      f.write("}\n")
       f.close()
 
 
@@ -400,18 +465,83 @@ class irrp:
          cycle = 1000.0 / frequency
          cycles = int(round(micros/cycle))
          on = int(round(cycle / 2.0))
-         sofar = 0
+
+         # Each cycle ends on a rounded multiple of the cycle length,
+         # the off time takes up whatever is left after the fixed on time.
+         # Only a couple of distinct off times occur so pulses are shared.
+         ends = [int(round(c*cycle)) for c in range(cycles+1)]
+         mark = pigpio.pulse(1<<gpio, 0, on)
+         spaces = {}
          for c in range(cycles):
-            target = int(round((c+1)*cycle))
-            sofar += on
-            off = target - sofar
-            sofar += off
-            wf.append(pigpio.pulse(1<<gpio, 0, on))
-            wf.append(pigpio.pulse(0, 1<<gpio, off))
+            off = ends[c+1] - ends[c] - on
+            if off not in spaces:
+               spaces[off] = pigpio.pulse(0, 1<<gpio, off)
+            wf.append(mark)
+            wf.append(spaces[off])
          return wf
 
+      def chain(wave):
+         """
+         Replace runs of the same mark and space in a wave chain
+         with a pigpio chain loop.
+
+         255 0 mark space 255 1 x y
+
+         transmits mark space x + 256*y times in 8 bytes, so only
+         runs of 5 or more pairs are shortened.
+         """
+         runs = []
+         i = 0
+         while i + 1 < len(wave):
+            n = 1
+            while (i+2*n+1 < len(wave) and
+                   wave[i+2*n] == wave[i] and wave[i+2*n+1] == wave[i+1]):
+               n += 1
+            if n >= 5:
+               runs.append((i, n))
+            i += 2*n
+
+         # pigpio sizes a chain for about 600 entries and 20 loop
+         # counters, if there are more runs use the longest.
+         runs = sorted(sorted(runs, key=lambda r: -r[1])[:CHAIN_LOOPS])
+
+         ch = []
+         j = 0
+         for i, n in runs:
+            ch.extend(wave[j:i])
+            ch.extend([255, 0, wave[i], wave[i+1], 255, 1, n & 255, n >> 8])
+            j = i + 2*n
+         ch.extend(wave[j:])
+         return ch
+
+      def create_waves(code):
+         """
+         Create a wave for each mark and space of code which
+         doesn't have one yet.
+         """
+         add = pi.wave_add_generic
+         create = pi.wave_create
+         pulse = pigpio.pulse
+
+         for ci in sorted(set(code[0::2]).difference(marks_wid)):
+            add(carrier(gpio, freq, ci))
+            marks_wid[ci] = create()
+
+         for ci in sorted(set(code[1::2]).difference(spaces_wid)):
+            add([pulse(0, 0, ci)])
+            spaces_wid[ci] = create()
+
+      def clear_waves():
+         """
+         Delete all the waves, including any partly built one.
+         """
+         pi.wave_clear()
+         marks_wid.clear()
+         spaces_wid.clear()
+
       GAP_MS = gap
       GAP_S = GAP_MS/1000.0
+      CHAIN_LOOPS = 20
 
       pi = pigpio.pi() # Connect to Pi.
 
@@ -425,7 +555,7 @@ class irrp:
          print("Can't open: {}".format(FILE))
          exit(0)
 
-      records = json.load(f)
+      records = resolve_codes(json.load(f))
 
       f.close()
 
@@ -433,6 +563,31 @@ class irrp:
 
       pi.wave_add_new()
 
+      codes = {}
+
+      for arg in id_list:
+         if arg in records and arg not in codes:
+            # Older files may hold fractional lengths which pigpio
+            # won't take.
+            codes[arg] = [int(round(v)) for v in records[arg]]
+
+      # Waves are shared by every key played, the carrier frequency
+      # is fixed so a pulse length identifies its wave.
+
+      marks_wid = {}
+      spaces_wid = {}
+
+      # Create the waves for all the keys before the first key is sent
+      # so that no uploads are needed between keys.  pigpio only has
+      # room for 250 waves and a limited number of pulses, if the keys
+      # don't fit together each key's waves are created as it is sent.
+
+      try:
+         for code in codes.values():
+            create_waves(code)
+      except pigpio.error:
+         clear_waves()
+
       emit_time = time.time()
 
       if self.VERBOSE:
@@ -440,30 +595,21 @@ class irrp:
 
       #for arg in args.id:
       for arg in id_list:
-         if arg in records:
-
-            code = records[arg]
+         if arg in codes:
 
-            # Create wave
+            code = codes[arg]
 
-            marks_wid = {}
-            spaces_wid = {}
+            try:
+               create_waves(code)
+            except pigpio.error: # Out of room, drop the other keys' waves.
+               clear_waves()
+               create_waves(code)
 
             wave = [0]*len(code)
+            wave[0::2] = [marks_wid[ci] for ci in code[0::2]]
+            wave[1::2] = [spaces_wid[ci] for ci in code[1::2]]
 
-            for i in range(0, len(code)):
-               ci = code[i]
-               if i & 1: # Space
-                  if ci not in spaces_wid:
-                     pi.wave_add_generic([pigpio.pulse(0, 0, ci)])
-                     spaces_wid[ci] = pi.wave_create()
-                  wave[i] = spaces_wid[ci]
-               else: # Mark
-                  if ci not in marks_wid:
-                     wf = carrier(gpio, freq, ci)
-                     pi.wave_add_generic(wf)
-                     marks_wid[ci] = pi.wave_create()
-                  wave[i] = marks_wid[ci]
+            wave = chain(wave)
 
             delay = emit_time - time.time()
 
@@ -475,24 +621,26 @@ class irrp:
             if self.VERBOSE:
                print("key " + arg)
 
+            # The code lasts sum(code) micros, sleep through most of it
+            # and only poll for the tail.  pi.wave_get_micros() can't be
+            # used to check this, it only measures the waveform still
+            # being built and not a chain of created waves.
+            time.sleep(max(0.0, sum(code)/1000000.0 - 0.005))
+
             while pi.wave_tx_busy():
                time.sleep(0.002)
 
             emit_time = time.time() + GAP_S
 
-            for i in marks_wid:
-               pi.wave_delete(marks_wid[i])
-
-            marks_wid = {}
-
-            for i in spaces_wid:
-               pi.wave_delete(spaces_wid[i])
-
-            spaces_wid = {}
-
          else:
             print("Id {} not found".format(arg))
 
+      for i in marks_wid:
+         pi.wave_delete(marks_wid[i])
+
+      for i in spaces_wid:
+         pi.wave_delete(spaces_wid[i])
+
       pi.stop() # Disconnect from Pi.
 
 